@@ -1,28 +1,190 @@
 import os
-import json
+import re
+import uuid
+import io
+import asyncio
+import hashlib
+import orjson
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from string import Template
+from typing import Optional
+from cachetools import LRUCache, TTLCache
+from PIL import Image
 from dotenv import load_dotenv
-from fastapi import FastAPI, UploadFile, Form, File
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, UploadFile, Form, File, Depends
+from fastapi.responses import Response, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
+from starlette.background import BackgroundTask
 
 # Vertex AI (GCP)
 import vertexai
-from vertexai.generative_models import GenerativeModel, Part, GenerationConfig
+from vertexai.generative_models import GenerativeModel, Part, GenerationConfig, FinishReason
+from vertexai.batch_prediction import BatchPredictionJob
+from google.cloud import storage
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 env_path = os.path.join(BASE_DIR, ".env")
 load_dotenv(dotenv_path=env_path)
 
-GCP_PROJECT_ID = os.getenv("GCP_PROJECT_ID")
-GCP_LOCATION = os.getenv("GCP_LOCATION", "us-central1")
-GCP_MODEL_NAME = os.getenv("GCP_MODEL_NAME", "gemini-1.5-pro")
+@dataclass(frozen=True)
+class Settings:
+    """
+    Configuration read from the environment once, at import.
+    Handlers only read attributes; nothing calls os.getenv per request.
+    """
+    project_id: Optional[str]
+    location: str
+    model_name: str
+    warm_up_model: bool  # 1-token (billed) generation per worker at startup
+    # Concurrency and caches (per worker)
+    max_inflight: int
+    response_cache_size: int
+    response_cache_ttl: int  # seconds
+    image_part_cache_bytes: int
+    # Large uploads via GCS (disabled unless gcs_upload_bucket is set)
+    gcs_upload_bucket: Optional[str]
+    gcs_upload_prefix: str
+    gcs_upload_min_bytes: int
+    gcs_batch_prefix: str
+    # Inline image downscaling
+    image_max_edge: int
+    image_downscale_min_bytes: int
+    # Server (python main.py)
+    host: str
+    port: int
+    workers: int
+    limit_concurrency: int
+    # Generation
+    temperature: float = 0.7
+    top_p: float = 0.95
+    max_output_tokens: int = 1500
+
+SETTINGS = Settings(
+    project_id=os.getenv("GCP_PROJECT_ID"),
+    location=os.getenv("GCP_LOCATION", "us-central1"),
+    model_name=os.getenv("GCP_MODEL_NAME", "gemini-1.5-pro"),
+    warm_up_model=os.getenv("WARM_UP_MODEL", "1").strip().lower() not in ("0", "false", "no"),
+    max_inflight=int(os.getenv("MAX_INFLIGHT", "16")),
+    response_cache_size=int(os.getenv("RESPONSE_CACHE_SIZE", "256")),
+    response_cache_ttl=int(os.getenv("RESPONSE_CACHE_TTL", "3600")),
+    image_part_cache_bytes=int(os.getenv("IMAGE_PART_CACHE_BYTES", str(64 * 1024 * 1024))),
+    gcs_upload_bucket=os.getenv("GCS_UPLOAD_BUCKET"),
+    gcs_upload_prefix=os.getenv("GCS_UPLOAD_PREFIX", "analyze_threats/"),
+    gcs_upload_min_bytes=int(os.getenv("GCS_UPLOAD_MIN_BYTES", str(4 * 1024 * 1024))),
+    gcs_batch_prefix=os.getenv("GCS_BATCH_PREFIX", "analyze_threats_batch/"),
+    image_max_edge=int(os.getenv("IMAGE_MAX_EDGE", "1536")),
+    image_downscale_min_bytes=int(os.getenv("IMAGE_DOWNSCALE_MIN_BYTES", "200000")),
+    host=os.getenv("HOST", "0.0.0.0"),
+    port=int(os.getenv("PORT", "8000")),
+    workers=int(os.getenv("WEB_CONCURRENCY", str(os.cpu_count() or 1))),
+    limit_concurrency=int(os.getenv("LIMIT_CONCURRENCY", "256")),
+)
 
 # Initialize Vertex AI
-vertexai.init(project=GCP_PROJECT_ID, location=GCP_LOCATION)
-model = GenerativeModel(GCP_MODEL_NAME)
+vertexai.init(project=SETTINGS.project_id, location=SETTINGS.location)
+model = GenerativeModel(SETTINGS.model_name)
+
+# Structured output: Gemini must reply with JSON matching this schema
+STRIDE_THREAT_TYPES = [
+    "Spoofing",
+    "Tampering",
+    "Repudiation",
+    "Information Disclosure",
+    "Denial of Service",
+    "Elevation of Privilege",
+]
+THREAT_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "threat_model": {
+            "type": "ARRAY",
+            "items": {
+                "type": "OBJECT",
+                "properties": {
+                    "Threat Type": {"type": "STRING", "enum": STRIDE_THREAT_TYPES},
+                    "Scenario": {"type": "STRING"},
+                    "Potential Impact": {"type": "STRING"},
+                },
+                "required": ["Threat Type", "Scenario", "Potential Impact"],
+            },
+        },
+        "improvement_suggestions": {"type": "ARRAY", "items": {"type": "STRING"}},
+    },
+    "required": ["threat_model", "improvement_suggestions"],
+}
+
+# Generation config (constant, shared by every request and by batch jobs)
+GENERATION_PARAMS = {
+    "temperature": SETTINGS.temperature,
+    "top_p": SETTINGS.top_p,
+    "max_output_tokens": SETTINGS.max_output_tokens,
+    "response_mime_type": "application/json",
+    "response_schema": THREAT_SCHEMA,
+}
+GEN_CFG = GenerationConfig(**GENERATION_PARAMS)
+
+# Upper bound on concurrent Gemini calls per worker
+model_semaphore = asyncio.Semaphore(SETTINGS.max_inflight)
+
+# Response cache: identical prompt + image -> previously parsed threat model
+response_cache = TTLCache(maxsize=SETTINGS.response_cache_size, ttl=SETTINGS.response_cache_ttl)
+
+# Inline image Parts (already downscaled) by (image digest, mime type), for reuse across prompts.
+# Entries are (Part, payload size) and the cache is bounded by total payload bytes, not entry count.
+image_part_cache = LRUCache(maxsize=SETTINGS.image_part_cache_bytes, getsizeof=lambda entry: entry[1])
+
+# Singleflight: cache key -> future of the request currently calling Gemini for it
+_inflight: dict[str, asyncio.Future] = {}
+
+# Large uploads are streamed to a short-lived GCS object and passed to Gemini by URI.
+# Disabled unless GCS_UPLOAD_BUCKET is set.
+UPLOAD_CHUNK_SIZE = 1024 * 1024  # 1 MiB, also a valid resumable-upload chunk size
+storage_client = storage.Client(project=SETTINGS.project_id) if SETTINGS.gcs_upload_bucket else None
+_background_tasks = set()
+
+# Inline images above image_downscale_min_bytes are resized (long edge) and re-encoded as WebP;
+# Gemini tiles images at ~768 px, so extra resolution only costs bandwidth and tokens.
+IMAGE_WEBP_QUALITY = 80
+
+# Bulk analysis via Vertex batch prediction (inputs/outputs live in the GCS upload bucket)
+FORM_FIELDS = (
+    "application_type",
+    "authentication_methods",
+    "internet_exposed",
+    "sensitive_data",
+    "application_description",
+)
+
+class OrjsonResponse(Response):
+    """
+    JSON response encoded with orjson.
+    Local replacement for fastapi.responses.ORJSONResponse, which is deprecated in recent FastAPI.
+    """
+    media_type = "application/json"
+
+    def render(self, content) -> bytes:
+        return orjson.dumps(content)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Open the async prediction channel (TLS + auth) that generate_content_async uses,
+    before the first real request. A 1-token generation, skipped unless
+    SETTINGS.warm_up_model; failures and timeouts are ignored.
+    """
+    if SETTINGS.warm_up_model:
+        try:
+            await asyncio.wait_for(
+                model.generate_content_async("ping", generation_config=GenerationConfig(max_output_tokens=1)),
+                timeout=10,
+            )
+        except Exception:
+            pass
+    yield
 
-# FastAPI + CORS
-app = FastAPI()
+# FastAPI (orjson responses, model warm-up on startup) + CORS
+app = FastAPI(default_response_class=OrjsonResponse, lifespan=lifespan)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -42,21 +204,21 @@ Regras de saída:
 - Liste 3–4 ameaças por categoria STRIDE, se aplicável, com cenários plausíveis no contexto fornecido.
 
 Contexto:
-TIPO_DE_APLICACAO: {application_type}
-METODOS_DE_AUTENTICACAO: {authentication_methods}
-EXPOSTA_NA_INTERNET: {internet_exposed}
-DADOS_SENSIVEIS: {sensitive_data}
-RESUMO_DESCRICAO: {application_description}
+TIPO_DE_APLICACAO: ${application_type}
+METODOS_DE_AUTENTICACAO: ${authentication_methods}
+EXPOSTA_NA_INTERNET: ${internet_exposed}
+DADOS_SENSIVEIS: ${sensitive_data}
+RESUMO_DESCRICAO: ${application_description}
 
 Saída esperada (SOMENTE JSON):
-{{
+{
   "threat_model": [
-    {{ "Threat Type": "Spoofing", "Scenario": "…", "Potential Impact": "…" }}
+    { "Threat Type": "Spoofing", "Scenario": "…", "Potential Impact": "…" }
   ],
   "improvement_suggestions": [
     "…"
   ]
-}}"""
+}"""
 
 EN_TEMPLATE = """Act as a cybersecurity expert with 20+ years of experience,
 using the STRIDE methodology to produce a threat model for the application and for the ARCHITECTURE IN THE ATTACHED IMAGE.
@@ -68,21 +230,30 @@ Output rules:
 - List 3–4 threats per STRIDE category, if applicable, with plausible scenarios in the provided context.
 
 Context:
-APPLICATION_TYPE: {application_type}
-AUTHENTICATION_METHODS: {authentication_methods}
-INTERNET_EXPOSED: {internet_exposed}
-SENSITIVE_DATA: {sensitive_data}
-SUMMARY_DESCRIPTION: {application_description}
+APPLICATION_TYPE: ${application_type}
+AUTHENTICATION_METHODS: ${authentication_methods}
+INTERNET_EXPOSED: ${internet_exposed}
+SENSITIVE_DATA: ${sensitive_data}
+SUMMARY_DESCRIPTION: ${application_description}
 
 Expected output (JSON ONLY):
-{{
+{
   "threat_model": [
-    {{ "Threat Type": "Spoofing", "Scenario": "…", "Potential Impact": "…" }}
+    { "Threat Type": "Spoofing", "Scenario": "…", "Potential Impact": "…" }
   ],
   "improvement_suggestions": [
     "…"
   ]
-}}"""
+}"""
+
+# Parsed once at import; selected by the first two letters of `prompt_language`.
+# Common spellings are keyed directly so the usual case is a single dict lookup.
+PT_TPL = Template(PT_TEMPLATE)
+EN_TPL = Template(EN_TEMPLATE)
+_TEMPLATES = {
+    "en": EN_TPL, "En": EN_TPL, "EN": EN_TPL,
+    "pt": PT_TPL, "Pt": PT_TPL, "PT": PT_TPL,
+}
 
 def create_threat_model_prompt(
     application_type: str,
@@ -96,9 +267,11 @@ def create_threat_model_prompt(
     Build the STRIDE prompt in the selected language ("pt" or "en").
     Choose language via form field `prompt_language`.
     """
-    lang = (prompt_language or "en").strip().lower()
-    template = EN_TEMPLATE if lang.startswith("en") else PT_TEMPLATE
-    return template.format(
+    template = _TEMPLATES.get(prompt_language[:2] if prompt_language else "en")
+    if template is None:
+        # Anything else (padding, "fr", ...) is normalised; unknown languages fall back to PT
+        template = _TEMPLATES.get(prompt_language.strip().lower()[:2], PT_TPL)
+    return template.substitute(
         application_type=application_type,
         authentication_methods=authentication_methods,
         internet_exposed=internet_exposed,
@@ -106,62 +279,604 @@ def create_threat_model_prompt(
         application_description=application_description,
     )
 
-@app.post("/analyze_threats")
-async def analyze_threats(
-    image: UploadFile = File(...),
+def upload_size(fileobj) -> int:
+    """
+    Size of an uploaded file in bytes; leaves the file rewound.
+    """
+    fileobj.seek(0, 2)
+    size = fileobj.tell()
+    fileobj.seek(0)
+    return size
+
+def digest_upload(fileobj) -> str:
+    """
+    Hash an uploaded file in chunks, without loading it into memory.
+    Returns the hex digest and rewinds the file.
+    """
+    h = hashlib.blake2b(digest_size=32)
+    fileobj.seek(0)
+    for chunk in iter(lambda: fileobj.read(UPLOAD_CHUNK_SIZE), b""):
+        h.update(chunk)
+    fileobj.seek(0)
+    return h.hexdigest()
+
+def read_upload(fileobj, size: int) -> tuple[bytes, str]:
+    """
+    Read an uploaded file with a single, pre-sized read and hash it.
+    Returns (bytes, hex digest).
+    """
+    fileobj.seek(0)
+    data = fileobj.read(size)
+    return data, hashlib.blake2b(data, digest_size=32).hexdigest()
+
+def response_cache_key(prompt: str, image_hash: str, mime_type: str) -> str:
+    """
+    Exact-match cache key over the rendered prompt and the image digest.
+    """
+    h = hashlib.blake2b(digest_size=32)
+    h.update(prompt.encode("utf-8"))
+    h.update(b"|")
+    h.update(mime_type.encode("utf-8"))
+    h.update(b"|")
+    h.update(image_hash.encode("ascii"))
+    return h.hexdigest()
+
+async def upload_image_to_gcs(fileobj, mime_type: str, prefix: str = SETTINGS.gcs_upload_prefix) -> storage.Blob:
+    """
+    Stream the upload to GCS with a chunked resumable upload, off the event loop.
+    """
+    blob = storage_client.bucket(SETTINGS.gcs_upload_bucket).blob(f"{prefix}{uuid.uuid4().hex}")
+    blob.chunk_size = UPLOAD_CHUNK_SIZE
+    await asyncio.to_thread(blob.upload_from_file, fileobj, content_type=mime_type, rewind=True)
+    return blob
+
+def schedule_blob_delete(blob: storage.Blob) -> None:
+    """
+    Fire-and-forget deletion of a temporary upload; failures are ignored.
+    """
+    async def _delete():
+        try:
+            await asyncio.to_thread(blob.delete)
+        except Exception:
+            pass
+
+    task = asyncio.create_task(_delete())
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+
+def downscale_image(image_bytes: bytes, mime_type: str) -> tuple[bytes, str]:
+    """
+    Resize to SETTINGS.image_max_edge and re-encode as WebP.
+    Returns the original bytes if decoding fails or the result isn't smaller.
+    """
+    try:
+        with Image.open(io.BytesIO(image_bytes)) as img:
+            img.thumbnail((SETTINGS.image_max_edge, SETTINGS.image_max_edge), Image.LANCZOS)
+            if img.mode not in ("RGB", "RGBA"):
+                img = img.convert("RGBA" if "A" in img.mode or "transparency" in img.info else "RGB")
+            buf = io.BytesIO()
+            img.save(buf, "WEBP", quality=IMAGE_WEBP_QUALITY, method=4)
+    except Exception:
+        return image_bytes, mime_type
+    new_bytes = buf.getvalue()
+    if len(new_bytes) >= len(image_bytes):
+        return image_bytes, mime_type
+    return new_bytes, "image/webp"
+
+async def load_image(image: UploadFile) -> tuple[Optional[bytes], str, str]:
+    """
+    Returns (image bytes, image digest, mime type).
+    Large images are only hashed (they are streamed to GCS later) and come back
+    with bytes=None; small ones are read once.
+    """
+    mime_type = image.content_type or "image/png"
+    image_size = upload_size(image.file)
+    if storage_client is not None and image_size >= SETTINGS.gcs_upload_min_bytes:
+        image_hash = await asyncio.to_thread(digest_upload, image.file)
+        return None, image_hash, mime_type
+    image_bytes, image_hash = await asyncio.to_thread(read_upload, image.file, image_size)
+    return image_bytes, image_hash, mime_type
+
+async def build_image_part(
+    image: UploadFile,
+    image_bytes: Optional[bytes],
+    image_hash: str,
+    mime_type: str,
+) -> tuple[Part, Optional[storage.Blob]]:
+    """
+    Image Part for Gemini: a GCS URI when `image_bytes` is None (the returned
+    blob must be deleted after the call), otherwise cached inline data.
+    """
+    if image_bytes is None:
+        blob = await upload_image_to_gcs(image.file, mime_type)
+        return Part.from_uri(uri=f"gs://{SETTINGS.gcs_upload_bucket}/{blob.name}", mime_type=mime_type), blob
+
+    part_key = (image_hash, mime_type)
+    cached = image_part_cache.get(part_key)
+    if cached is not None:
+        return cached[0], None
+    part_mime_type = mime_type
+    if len(image_bytes) >= SETTINGS.image_downscale_min_bytes:
+        image_bytes, part_mime_type = await asyncio.to_thread(downscale_image, image_bytes, mime_type)
+    # Raw bytes go straight into the proto (memoryview is rejected); over the SDK's
+    # default gRPC transport they are sent as binary, so there is no base64 step to precompute.
+    image_part = Part.from_data(mime_type=part_mime_type, data=image_bytes)
+    # Payloads that don't fit the whole budget (e.g. undecodable uploads kept at full size) aren't cached
+    if len(image_bytes) <= image_part_cache.maxsize:
+        image_part_cache[part_key] = (image_part, len(image_bytes))
+    return image_part, None
+
+# Outermost {...} in a reply that wraps its JSON in markdown or prose
+_JSON_OBJECT_RE = re.compile(r"\{.*\}", re.DOTALL)
+
+def parse_model_text(text: str) -> Optional[dict]:
+    """
+    Parse the model's JSON reply; None if it isn't valid JSON.
+    If the JSON is wrapped in markdown or prose, the outermost {...} is tried before giving up.
+    Schema-constrained output can still be truncated at max_output_tokens.
+    """
+    try:
+        return orjson.loads(text)
+    except orjson.JSONDecodeError:
+        pass
+    m = _JSON_OBJECT_RE.search(text)
+    if m is None:
+        return None
+    try:
+        return orjson.loads(m.group(0))
+    except orjson.JSONDecodeError:
+        return None
+
+async def generate_threat_model(
+    prompt: str,
+    image: UploadFile,
+    image_bytes: Optional[bytes],
+    image_hash: str,
+    mime_type: str,
+    cache_key: str,
+) -> dict:
+    """
+    Send prompt + image to Gemini and return the parsed JSON (cached) or raw text.
+    """
+    image_part, blob = await build_image_part(image, image_bytes, image_hash, mime_type)
+
+    # Multimodal content
+    contents = [
+        prompt,
+        image_part,
+    ]
+
+    try:
+        async with model_semaphore:
+            response = await model.generate_content_async(contents, generation_config=GEN_CFG)
+    finally:
+        if blob is not None:
+            schedule_blob_delete(blob)
+
+    text = response.text or ""
+    parsed = parse_model_text(text)
+    if parsed is None:
+        return {"raw_text": text}
+    response_cache[cache_key] = parsed
+    return parsed
+
+async def _analyze_impl(image: UploadFile, fields: dict, prompt_language: str) -> OrjsonResponse:
+    """
+    Shared core of the EN and PT single-image routes:
+    - Builds a PT/EN STRIDE prompt from `fields` (keyed by FORM_FIELDS)
+    - Returns a cached result for an identical prompt + image, if any
+    - Joins an identical request that is already waiting on Gemini
+    - Sends multimodal (text + image) to Vertex Gemini
+    - Returns the model's JSON or raw text if parsing fails
+    """
+    try:
+        # Build prompt
+        prompt = create_threat_model_prompt(**fields, prompt_language=prompt_language)
+
+        image_bytes, image_hash, mime_type = await load_image(image)
+
+        # Short-circuit identical submissions
+        cache_key = response_cache_key(prompt, image_hash, mime_type)
+        cached = response_cache.get(cache_key)
+        if cached is not None:
+            return OrjsonResponse(content=cached, status_code=200)
+
+        # Coalesce with an identical request already waiting on Gemini
+        while (inflight := _inflight.get(cache_key)) is not None:
+            try:
+                return OrjsonResponse(content=await asyncio.shield(inflight), status_code=200)
+            except asyncio.CancelledError:
+                if not inflight.cancelled():
+                    raise  # this request itself was cancelled
+                # The leader was cancelled (e.g. its client went away): join a newer
+                # leader if another waiter already took over, otherwise call Gemini ourselves
+
+        fut = asyncio.get_running_loop().create_future()
+        _inflight[cache_key] = fut
+        try:
+            content = await generate_threat_model(prompt, image, image_bytes, image_hash, mime_type, cache_key)
+            fut.set_result(content)
+        except asyncio.CancelledError:
+            fut.cancel()
+            raise
+        except Exception as e:
+            fut.set_exception(e)
+            fut.exception()  # mark as retrieved when nobody else was waiting
+            raise
+        finally:
+            _inflight.pop(cache_key, None)
+        return OrjsonResponse(content=content, status_code=200)
+
+    except Exception as e:
+        return OrjsonResponse(content={"error": str(e)}, status_code=500)
+
+def english_form_fields(
     application_type: str = Form(...),
     authentication_methods: str = Form(...),
     internet_exposed: str = Form(...),
     sensitive_data: str = Form(...),
     application_description: str = Form(...),
+) -> dict:
+    """
+    Analysis fields from the English form, keyed by FORM_FIELDS (shared by the plain and /stream routes).
+    """
+    return {
+        "application_type": application_type,
+        "authentication_methods": authentication_methods,
+        "internet_exposed": internet_exposed,
+        "sensitive_data": sensitive_data,
+        "application_description": application_description,
+    }
+
+def portuguese_form_fields(
+    tipo_aplicacao: str = Form(...),
+    metodos_autenticacao: str = Form(...),
+    exposta_internet: str = Form(...),
+    dados_sensiveis: str = Form(...),
+    descricao_aplicacao: str = Form(...),
+) -> dict:
+    """
+    Analysis fields from the Portuguese form, keyed by FORM_FIELDS (shared by the plain and /stream routes).
+    """
+    return {
+        "application_type": tipo_aplicacao,
+        "authentication_methods": metodos_autenticacao,
+        "internet_exposed": exposta_internet,
+        "sensitive_data": dados_sensiveis,
+        "application_description": descricao_aplicacao,
+    }
+
+@app.post("/analyze_threats")
+async def analyze_threats(
+    image: UploadFile = File(...),
+    fields: dict = Depends(english_form_fields),
     prompt_language: str = Form("en"),  # "en" or "pt"
 ):
     """
-    FastAPI handler that:
-    - Builds a PT/EN STRIDE prompt
-    - Sends multimodal (text + image) to Vertex Gemini
-    - Returns the model's JSON or raw text if parsing fails
+    FastAPI handler (English field names).
+    """
+    return await _analyze_impl(image, fields, prompt_language)
+
+@app.post("/analisar_ameacas")
+async def analisar_ameacas(
+    imagem: UploadFile = File(...),
+    fields: dict = Depends(portuguese_form_fields),
+    idioma_prompt: str = Form("pt"),  # "pt" or "en"
+):
+    """
+    FastAPI handler (Portuguese field names); same behaviour as /analyze_threats.
+    """
+    return await _analyze_impl(imagem, fields, idioma_prompt)
+
+def ndjson_event(event: dict) -> bytes:
+    """
+    One NDJSON line for the streaming endpoints.
+    """
+    return orjson.dumps(event) + b"\n"
+
+async def _analyze_stream_impl(image: UploadFile, fields: dict, prompt_language: str) -> Response:
+    """
+    Shared core of the EN and PT streaming routes. Streams NDJSON so clients can render early:
+    - {"type": "chunk", "text": "..."} for each piece of model output
+    - a final {"type": "result", "data": {...}} (parsed JSON, or {"raw_text": ...})
+    - or {"type": "error", "error": "..."}
+    Cached results are sent as a single "result" event.
     """
     try:
-        # Build prompt
-        prompt = create_threat_model_prompt(
-            application_type=application_type,
-            authentication_methods=authentication_methods,
-            internet_exposed=internet_exposed,
-            sensitive_data=sensitive_data,
-            application_description=application_description,
-            prompt_language=prompt_language,
-        )
+        prompt = create_threat_model_prompt(**fields, prompt_language=prompt_language)
+        image_bytes, image_hash, mime_type = await load_image(image)
+        cache_key = response_cache_key(prompt, image_hash, mime_type)
+        cached = response_cache.get(cache_key)
+        if cached is not None:
+            return StreamingResponse(
+                iter([ndjson_event({"type": "result", "data": cached})]), media_type="application/x-ndjson"
+            )
+        # The upload is consumed here, before the response body starts streaming
+        image_part, blob = await build_image_part(image, image_bytes, image_hash, mime_type)
+    except Exception as e:
+        return OrjsonResponse(content={"error": str(e)}, status_code=500)
+
+    blob_deleted = False
 
-        # Read uploaded image
-        image_bytes = await image.read()
-        mime_type = image.content_type or "image/png"
-        if isinstance(image_bytes, bytearray):
-            image_bytes = bytes(image_bytes)
-        image_part = Part.from_data(mime_type=mime_type, data=image_bytes)
-
-        # Multimodal content
-        contents = [
-            prompt,
-            image_part,
-            "Analyze the image and the text above and return ONLY the JSON described in the instructions.",
-        ]
-
-        # Generation config
-        cfg = GenerationConfig(
-            temperature=0.7,
-            top_p=0.95,
-            max_output_tokens=1500,
+    async def release_blob():
+        # Called when generation ends, when the body closes and as the response's
+        # background task, so the object is removed even if the body never starts
+        nonlocal blob_deleted
+        if blob is not None and not blob_deleted:
+            blob_deleted = True
+            schedule_blob_delete(blob)
+
+    async def read_model_stream(queue: asyncio.Queue):
+        # Holds a Gemini slot only while the model is generating; chunks are buffered
+        # in the queue so a slow-reading client doesn't keep the slot busy
+        try:
+            produced_text = False
+            finish_reason = None
+            async with model_semaphore:
+                stream = await model.generate_content_async(
+                    [prompt, image_part], generation_config=GEN_CFG, stream=True
+                )
+                async for chunk in stream:
+                    if chunk.candidates:
+                        finish_reason = chunk.candidates[0].finish_reason
+                    try:
+                        text = chunk.text
+                    except ValueError:  # e.g. a final chunk carrying only finish_reason
+                        continue
+                    if text:
+                        produced_text = True
+                        queue.put_nowait(text)
+            # A fully blocked reply (safety, recitation, blocked prompt) yields no text at all
+            if not produced_text and finish_reason != FinishReason.STOP:
+                reason = finish_reason.name if finish_reason is not None else "no candidates"
+                raise ValueError(f"Gemini returned no text (finish reason: {reason})")
+        except Exception as e:
+            queue.put_nowait(e)
+        finally:
+            queue.put_nowait(None)
+            await release_blob()
+
+    async def events():
+        queue = asyncio.Queue()
+        reader = asyncio.create_task(read_model_stream(queue))
+        chunks = []
+        try:
+            while (item := await queue.get()) is not None:
+                if isinstance(item, Exception):
+                    yield ndjson_event({"type": "error", "error": str(item)})
+                    return
+                chunks.append(item)
+                yield ndjson_event({"type": "chunk", "text": item})
+        finally:
+            reader.cancel()
+            await release_blob()
+
+        text = "".join(chunks)
+        parsed = parse_model_text(text)
+        if parsed is None:
+            yield ndjson_event({"type": "result", "data": {"raw_text": text}})
+            return
+        response_cache[cache_key] = parsed
+        yield ndjson_event({"type": "result", "data": parsed})
+
+    return StreamingResponse(events(), media_type="application/x-ndjson", background=BackgroundTask(release_blob))
+
+@app.post("/analyze_threats/stream")
+async def analyze_threats_stream(
+    image: UploadFile = File(...),
+    fields: dict = Depends(english_form_fields),
+    prompt_language: str = Form("en"),  # "en" or "pt"
+):
+    """
+    Streaming handler (English field names); same input as /analyze_threats.
+    """
+    return await _analyze_stream_impl(image, fields, prompt_language)
+
+@app.post("/analisar_ameacas/stream")
+async def analisar_ameacas_stream(
+    imagem: UploadFile = File(...),
+    fields: dict = Depends(portuguese_form_fields),
+    idioma_prompt: str = Form("pt"),  # "pt" or "en"
+):
+    """
+    Streaming handler (Portuguese field names); same input as /analisar_ameacas.
+    """
+    return await _analyze_stream_impl(imagem, fields, idioma_prompt)
+
+# Input file of a job submitted by /analyze_threats_batch: {GCS_BATCH_PREFIX}{uuid hex}/input.jsonl
+_BATCH_INPUT_RE = re.compile(re.escape(SETTINGS.gcs_batch_prefix) + r"[0-9a-f]{32}/input\.jsonl")
+
+def batch_location(job: BatchPredictionJob) -> Optional[tuple[str, str]]:
+    """
+    (bucket, batch prefix) of a job submitted by /analyze_threats_batch,
+    derived from its `{prefix}input.jsonl` input.
+    None for any other job in the project, which must not be read or cleaned up here.
+    """
+    uris = job.gca_resource.input_config.gcs_source.uris
+    if len(uris) != 1:
+        return None
+    bucket_name, _, input_name = uris[0].removeprefix("gs://").partition("/")
+    if bucket_name != SETTINGS.gcs_upload_bucket or not _BATCH_INPUT_RE.fullmatch(input_name):
+        return None
+    return bucket_name, input_name.removesuffix("input.jsonl")
+
+def batch_row_image_uri(row: dict) -> Optional[str]:
+    """
+    The image `file_uri` of the request echoed in a prediction output row.
+    """
+    try:
+        parts = row["request"]["contents"][0]["parts"]
+    except (KeyError, IndexError, TypeError):
+        return None
+    for part in parts:
+        file_data = part.get("file_data") or part.get("fileData") or {}
+        uri = file_data.get("file_uri") or file_data.get("fileUri")
+        if uri:
+            return uri
+    return None
+
+def read_batch_results(output_location: str, bucket_name: str, batch_prefix: str) -> dict:
+    """
+    Collect `image index -> parsed JSON (or raw text)` from the prediction JSONL files
+    a finished batch job wrote under `output_location`.
+    Rows are matched to images by the echoed image URI (via `images.json`, written at
+    submit time); rows that can't be matched are listed under "unmatched".
+    """
+    index_blob = storage_client.bucket(bucket_name).blob(f"{batch_prefix}images.json")
+    index_by_uri = orjson.loads(index_blob.download_as_bytes())
+
+    output_bucket, _, prefix = output_location.removeprefix("gs://").partition("/")
+    results = {}
+    for blob in storage_client.list_blobs(output_bucket, prefix=prefix):
+        if not blob.name.endswith(".jsonl"):
+            continue
+        for line in blob.download_as_bytes().splitlines():
+            if not line.strip():
+                continue
+            row = orjson.loads(line)
+            try:
+                text = row["response"]["candidates"][0]["content"]["parts"][0]["text"]
+            except (KeyError, IndexError, TypeError):
+                result = {"error": row.get("status") or "no response"}
+            else:
+                parsed = parse_model_text(text)
+                result = parsed if parsed is not None else {"raw_text": text}
+            key = index_by_uri.get(batch_row_image_uri(row)) or row.get("key")
+            if key is None:
+                results.setdefault("unmatched", []).append(result)
+            else:
+                results[key] = result
+    return results
+
+def delete_batch_inputs(bucket_name: str, batch_prefix: str) -> None:
+    """
+    Delete a finished job's uploaded images and input.jsonl. The small images.json
+    index and the output stay readable for later polls (see the readme's lifecycle rule).
+    """
+    for blob in storage_client.list_blobs(bucket_name, prefix=batch_prefix):
+        if blob.name.startswith(f"{batch_prefix}images/") or blob.name == f"{batch_prefix}input.jsonl":
+            blob.delete()
+
+@app.post("/analyze_threats_batch")
+async def analyze_threats_batch(
+    images: list[UploadFile] = File(...),
+    requests: str = Form(...),  # JSON array, one object of form fields per image
+    prompt_language: str = Form("en"),  # "en" or "pt"
+):
+    """
+    Bulk handler for offline workflows (CI scans, portfolio reviews):
+    - Streams every image to GCS and writes one JSONL request line per image
+    - Submits a single Vertex batch prediction job (cheaper than per-image calls)
+    - Returns the job id; poll GET /analyze_threats_batch/{job_id} for results
+    """
+    if storage_client is None:
+        return OrjsonResponse(content={"error": "GCS_UPLOAD_BUCKET is not configured"}, status_code=503)
+    try:
+        items = orjson.loads(requests)
+        if not isinstance(items, list) or len(items) != len(images):
+            return OrjsonResponse(
+                content={"error": "`requests` must be a JSON array with one object per image"},
+                status_code=400,
+            )
+        for i, item in enumerate(items):
+            missing = [f for f in FORM_FIELDS if not isinstance(item, dict) or f not in item]
+            if missing:
+                return OrjsonResponse(
+                    content={"error": f"requests[{i}] is missing: {', '.join(missing)}"},
+                    status_code=400,
+                )
+            if not isinstance(item.get("prompt_language", prompt_language), str):
+                return OrjsonResponse(
+                    content={"error": f"requests[{i}].prompt_language must be a string"},
+                    status_code=400,
+                )
+
+        batch_prefix = f"{SETTINGS.gcs_batch_prefix}{uuid.uuid4().hex}/"
+        bucket = storage_client.bucket(SETTINGS.gcs_upload_bucket)
+        index_by_uri = {}
+        lines = []
+        for i, (image, item) in enumerate(zip(images, items)):
+            prompt = create_threat_model_prompt(
+                **{f: item[f] for f in FORM_FIELDS},
+                prompt_language=item.get("prompt_language", prompt_language),
+            )
+            mime_type = image.content_type or "image/png"
+            blob = await upload_image_to_gcs(image.file, mime_type, prefix=f"{batch_prefix}images/")
+            image_uri = f"gs://{SETTINGS.gcs_upload_bucket}/{blob.name}"
+            index_by_uri[image_uri] = str(i)
+            lines.append(orjson.dumps({
+                "key": str(i),
+                "request": {
+                    "contents": [{
+                        "role": "user",
+                        "parts": [
+                            {"text": prompt},
+                            {"file_data": {"file_uri": image_uri, "mime_type": mime_type}},
+                        ],
+                    }],
+                    "generation_config": GENERATION_PARAMS,
+                },
+            }))
+
+        index_blob = bucket.blob(f"{batch_prefix}images.json")
+        await asyncio.to_thread(
+            index_blob.upload_from_string, orjson.dumps(index_by_uri), content_type="application/json"
+        )
+        input_blob = bucket.blob(f"{batch_prefix}input.jsonl")
+        await asyncio.to_thread(
+            input_blob.upload_from_string, b"\n".join(lines), content_type="application/jsonl"
         )
-        response = model.generate_content(contents, generation_config=cfg)
+        job = await asyncio.to_thread(
+            BatchPredictionJob.submit,
+            source_model=SETTINGS.model_name,
+            input_dataset=f"gs://{SETTINGS.gcs_upload_bucket}/{input_blob.name}",
+            output_uri_prefix=f"gs://{SETTINGS.gcs_upload_bucket}/{batch_prefix}output/",
+        )
+        return OrjsonResponse(content={"job_id": job.name, "state": job.state.name}, status_code=202)
+
+    except Exception as e:
+        return OrjsonResponse(content={"error": str(e)}, status_code=500)
 
-        # Try to parse JSON strictly
-        text = response.text or ""
+@app.get("/analyze_threats_batch/{job_id}")
+async def analyze_threats_batch_status(job_id: str):
+    """
+    Poll a batch job; once it has succeeded, return results keyed by the
+    index of each image in the original submission. Once the job has ended,
+    its uploaded images and input file are deleted.
+    Jobs not submitted by /analyze_threats_batch are reported as 404.
+    """
+    if storage_client is None:
+        return OrjsonResponse(content={"error": "GCS_UPLOAD_BUCKET is not configured"}, status_code=503)
+    try:
+        job = await asyncio.to_thread(BatchPredictionJob, job_id)
+        location = batch_location(job)
+        if location is None:
+            return OrjsonResponse(content={"error": "batch job not found"}, status_code=404)
+        if not job.has_ended:
+            return OrjsonResponse(content={"job_id": job_id, "state": job.state.name}, status_code=202)
+        bucket_name, batch_prefix = location
         try:
-            parsed = json.loads(text)
-            return JSONResponse(content=parsed, status_code=200)
-        except json.JSONDecodeError:
-            return JSONResponse(content={"raw_text": text}, status_code=200)
+            await asyncio.to_thread(delete_batch_inputs, bucket_name, batch_prefix)
+        except Exception:
+            pass  # best effort; the bucket lifecycle rule is the backstop
+        if not job.has_succeeded:
+            return OrjsonResponse(content={"job_id": job_id, "state": job.state.name, "error": job.error.message}, status_code=500)
+        results = await asyncio.to_thread(read_batch_results, job.output_location, bucket_name, batch_prefix)
+        return OrjsonResponse(content={"job_id": job_id, "state": job.state.name, "results": results}, status_code=200)
 
     except Exception as e:
-        return JSONResponse(content={"error": str(e)}, status_code=500)
+        return OrjsonResponse(content={"error": str(e)}, status_code=500)
+
+if __name__ == "__main__":
+    import uvicorn
+
+    # Production-style run: uvloop + httptools, one worker per CPU by default
+    uvicorn.run(
+        "main:app",
+        host=SETTINGS.host,
+        port=SETTINGS.port,
+        workers=SETTINGS.workers,
+        loop="uvloop",
+        http="httptools",
+        limit_concurrency=SETTINGS.limit_concurrency,
+    )